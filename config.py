@@ -1,5 +1,6 @@
 from pydantic_settings import BaseSettings
 from pydantic import Field
+from typing import Optional
 
 
 class Settings(BaseSettings):
@@ -23,6 +24,42 @@ class Settings(BaseSettings):
     CONTROL_API_BASE_URL: str
     CONTROL_WORKER_SHARED_SECRET: str
 
+    # =========================
+    # API key hashing
+    # =========================
+    # When set, keys are digested as HMAC-SHA256(pepper, key) instead of
+    # plain SHA-256. Must match the Control API's stored digests.
+    API_KEY_PEPPER: Optional[str] = Field(default=None)
+
+    # =========================
+    # Proxy
+    # =========================
+    # Upstream body bytes per ASGI send. 0 (default) relays reads as they
+    # arrive: lowest time-to-first-byte, right for interactive APIs.
+    # A positive size (e.g. 65536) trades latency for throughput by
+    # coalescing reads into fewer, larger sends, which suits bulk downloads.
+    # Only bodies with a content-length are ever coalesced; chunked and
+    # streaming replies always pass straight through.
+    PROXY_CHUNK_SIZE: int = Field(default=0)
+
+    # =========================
+    # ML risk scoring
+    # =========================
+    # When disabled, risk is a constant 0.0 and no ML state is touched.
+    ML_ENABLED: bool = Field(default=True)
+
+    # =========================
+    # Telemetry
+    # =========================
+    # Fraction of allowed requests that are logged/emitted.
+    # Rejections are always emitted.
+    TELEMETRY_SAMPLE_RATE: float = Field(default=1.0)
+
+    # Traffic events are flushed to the Control API when a batch is full
+    # or TRAFFIC_BATCH_MS after its first event, whichever comes first.
+    TRAFFIC_BATCH_SIZE: int = Field(default=100)
+    TRAFFIC_BATCH_MS: int = Field(default=50)
+
     class Config:
         env_file = ".env"
         case_sensitive = True
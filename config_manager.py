@@ -1,7 +1,8 @@
 import asyncio
 import logging
+import random
 import httpx
-from typing import Dict, Optional
+from typing import Callable, Dict, List, Optional, Set
 from pydantic import BaseModel
 
 from config import settings
@@ -18,13 +19,23 @@ class ProjectConfig(BaseModel):
     upstream_base_url: str
     api_key_hash: str
 
+    # Trailing slash stripped once at load time, not per request
+    upstream_base_url_normalized: str = ""
+
+    def model_post_init(self, __context) -> None:
+        if not self.upstream_base_url_normalized:
+            self.upstream_base_url_normalized = self.upstream_base_url.rstrip("/")
+
 
 class ConfigManager:
     _instance = None
+    _client: Optional[httpx.AsyncClient] = None
 
     def __init__(self):
         self._projects_by_key: Dict[str, ProjectConfig] = {}
-        self._lock = asyncio.Lock()
+        self._etag: Optional[str] = None
+        self._version: Optional[str] = None
+        self._update_listeners: List[Callable[[], None]] = []
         self._consecutive_failures = 0
         self._current_backoff = 10  # Start with 10s
 
@@ -34,9 +45,30 @@ class ConfigManager:
             cls._instance = cls()
         return cls._instance
 
+    def _get_client(self) -> httpx.AsyncClient:
+        """
+        Shared Control API client.
+        Keeps the keep-alive connection warm across refreshes.
+        """
+        if self._client is None:
+            self._client = httpx.AsyncClient(
+                timeout=5.0,
+                limits=httpx.Limits(max_keepalive_connections=4, max_connections=8),
+                headers={
+                    "x-control-secret": settings.CONTROL_WORKER_SHARED_SECRET
+                },
+            )
+        return self._client
+
     def start_background_refresh(self):
+        self._get_client()
         asyncio.create_task(self._refresh_loop())
 
+    async def close(self):
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
     async def initialize(self):
         """Force an initial config fetch (used in tests and startup)"""
         await self._fetch_and_update()
@@ -47,7 +79,7 @@ class ConfigManager:
         
         Design guarantees:
         - Never blocks request handling
-        - Exponential backoff on failures: 10s → 30s → 60s → 120s (max)
+        - Exponential backoff on failures: 10s → 20s → 40s → 80s → 120s (max), jittered
         - Reduced log noise: info on success, warning on first failure, error after 3 consecutive failures
         - Stale config continues to be used when refresh fails
         """
@@ -63,7 +95,10 @@ class ConfigManager:
         
         while True:
             try:
-                await asyncio.sleep(self._current_backoff)
+                # Jittered so worker replicas don't retry in lockstep
+                await asyncio.sleep(
+                    random.uniform(self._current_backoff * 0.5, self._current_backoff)
+                )
                 await self._fetch_and_update()
                 
                 # Success - reset backoff and failure counter
@@ -83,21 +118,30 @@ class ConfigManager:
                         f"Config refresh failed {self._consecutive_failures} times consecutively: {type(e).__name__}"
                     )
                 
-                # Exponential backoff: 10s → 30s → 60s → 120s (max)
+                # Exponential backoff: 10s → 20s → 40s → 80s → 120s (max)
                 self._current_backoff = min(self._current_backoff * 2, 120)
 
     async def _fetch_and_update(self):
         url = f"{settings.CONTROL_API_BASE_URL}/internal/worker/config"
 
-        async with httpx.AsyncClient(timeout=5.0) as client:
-            resp = await client.get(
-                url,
-                headers={
-                    "x-control-secret": settings.CONTROL_WORKER_SHARED_SECRET
-                },
-            )
-            resp.raise_for_status()
-            data = resp.json()
+        # Conditional GET: unchanged config costs no parsing or rebuild
+        headers = {"if-none-match": self._etag} if self._etag else None
+
+        resp = await self._get_client().get(url, headers=headers)
+        if resp.status_code == 304:
+            logger.debug("Config unchanged (304)")
+            return
+
+        resp.raise_for_status()
+        data = resp.json()
+
+        # Optional body-level version for Control APIs without ETag support
+        version = data.get("version")
+        if version is not None and version == self._version:
+            # Still adopt a new ETag so the next poll can revalidate with it
+            self._etag = resp.headers.get("etag")
+            logger.debug("Config unchanged (same version)")
+            return
 
         new_map: Dict[str, ProjectConfig] = {}
 
@@ -111,14 +155,29 @@ class ConfigManager:
                 api_key_hash=api_key_hash,
             )
 
-        async with self._lock:
-            self._projects_by_key = new_map
+        # Publish by reference swap (atomic in CPython); readers never lock.
+        # new_map must never be mutated after this point.
+        self._projects_by_key = new_map
+
+        self._etag = resp.headers.get("etag")
+        self._version = version
+
+        # Rotated/revoked keys must not survive in derived caches
+        for listener in self._update_listeners:
+            listener()
 
         logger.info(f"Loaded {len(new_map)} project configs")
 
+    def on_update(self, listener: Callable[[], None]):
+        """Register a callback fired after every newly published config."""
+        self._update_listeners.append(listener)
+
     def get_project_by_key(self, api_key_hash: str) -> Optional[ProjectConfig]:
         return self._projects_by_key.get(api_key_hash)
 
+    def upstream_base_urls(self) -> Set[str]:
+        return {p.upstream_base_url_normalized for p in self._projects_by_key.values()}
+
 
 # Singleton
 config_manager = ConfigManager.get_instance()
@@ -0,0 +1,113 @@
+import hashlib
+from types import SimpleNamespace
+from unittest.mock import AsyncMock, MagicMock, patch
+
+import httpx
+import pytest
+from fastapi import Response
+
+# Mock Redis before importing app modules that use it
+with patch("redis.asyncio.Redis"):
+    import main
+    import traffic_logger
+    from main import app
+    from http_clients import get_control_client
+    from config_manager import config_manager, ProjectConfig
+    from decision import Decision
+
+# Mock Data
+VALID_KEY = "test-key-123-must-be-longer-than-20-chars"
+VALID_KEY_HASH = hashlib.sha256(VALID_KEY.encode()).hexdigest()
+PROJECT_ID = "proj_123"
+UPSTREAM_URL = "http://backend.internal"
+
+# Built (and validated) once; tests only read it
+PROJECT_CFG = ProjectConfig(
+    project_id=PROJECT_ID,
+    upstream_base_url=UPSTREAM_URL,
+    api_key_hash=VALID_KEY_HASH,
+)
+
+# Shared upstream reply for the ALLOW path (starlette Responses can be replayed)
+OK_RESPONSE = Response(status_code=200)
+
+
+@pytest.fixture(scope="session")
+async def aclient():
+    """
+    One in-process AsyncClient per test process (each xdist worker builds its
+    own), on the shared session loop.
+    No lifespan: startup I/O is mocked per test.
+    """
+    transport = httpx.ASGITransport(app=app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://test") as c:
+        yield c
+
+
+@pytest.fixture(autouse=True)
+def fresh_state():
+    """
+    Every test starts with an empty auth cache and an unloaded config,
+    so results never depend on test order (or how xdist splits the run).
+    """
+    def reset():
+        main._auth_cache.clear()
+        config_manager._projects_by_key = {}
+        config_manager._etag = None
+        config_manager._version = None
+        config_manager._consecutive_failures = 0
+        config_manager._current_backoff = 10
+
+    reset()
+    yield
+    reset()
+
+
+@pytest.fixture
+def project_config():
+    return PROJECT_CFG
+
+
+@pytest.fixture
+def patched_config(monkeypatch, project_config):
+    """Every key lookup resolves to the default test project."""
+    monkeypatch.setattr(config_manager, "get_project_by_key", lambda *_: project_config)
+    return project_config
+
+
+@pytest.fixture
+def happy_mocks(monkeypatch):
+    """
+    Stubs every gateway stage for an ALLOW outcome.
+    Tests adjust return values on the exposed mocks as needed.
+    """
+    mocks = SimpleNamespace(
+        rate_limit=AsyncMock(return_value=(True, 100)),
+        risk=AsyncMock(return_value={"risk_score": 0.0}),
+        decision=MagicMock(return_value={"decision": Decision.ALLOW}),
+        forward=AsyncMock(return_value=OK_RESPONSE),
+    )
+    monkeypatch.setattr(main, "check_rate_limit", mocks.rate_limit)
+    monkeypatch.setattr(main, "compute_risk_score", mocks.risk)
+    monkeypatch.setattr(main, "make_decision", mocks.decision)
+    monkeypatch.setattr(main, "forward_request", mocks.forward)
+    return mocks
+
+
+@pytest.fixture
+def mock_traffic_post(monkeypatch):
+    """Replaces post() on the shared control client the traffic logger sends through."""
+    mock = AsyncMock()
+    monkeypatch.setattr(get_control_client(), "post", mock)
+    return mock
+
+
+@pytest.fixture
+def traffic_queue(monkeypatch):
+    """
+    Lets emitted events queue up without a running worker.
+    Tests drain them deterministically with flush_traffic_logger().
+    """
+    monkeypatch.setattr(traffic_logger, "_worker_started", True)
+    yield traffic_logger._log_queue
+    traffic_logger._log_queue.clear()
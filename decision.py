@@ -23,6 +23,20 @@ def make_decision(
     - Block only when clearly abusive
     """
 
+    # -------------------------
+    # FAST PATH (Healthy Traffic)
+    # -------------------------
+    # The overwhelmingly common case is matched with one combined check
+    if rate_limit_allowed and ml_risk_score < 0.6 and remaining_requests > 5:
+        return {
+            "decision": Decision.ALLOW,
+            "reason": "Usage within expected behavior",
+            "metadata": {
+                "remaining_requests": remaining_requests,
+                "risk_score": ml_risk_score,
+            },
+        }
+
     # -------------------------
     # HARD BLOCK (Confirmed Abuse)
     # -------------------------
@@ -70,7 +84,7 @@ def make_decision(
         }
 
     # -------------------------
-    # DEFAULT (Healthy Traffic)
+    # DEFAULT (non-comparable risk score, e.g. NaN)
     # -------------------------
     return {
         "decision": Decision.ALLOW,
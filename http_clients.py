@@ -0,0 +1,64 @@
+import httpx
+
+# --------------------------------------------------
+# Shared outbound HTTP clients, one per destination.
+# Built lazily on the running loop (see main startup) and
+# closed together by close_all() at shutdown.
+# --------------------------------------------------
+
+# Upstream (data plane): many concurrent calls, warm keep-alives
+UPSTREAM_LIMITS = httpx.Limits(
+    max_connections=1000,
+    max_keepalive_connections=500,
+    keepalive_expiry=60.0,
+)
+UPSTREAM_TIMEOUT = httpx.Timeout(30.0, connect=2.0)
+UPSTREAM_CONNECT_RETRIES = 1  # Connection failures only; requests are never replayed
+
+# Control API traffic export: small pool, must fail fast
+CONTROL_LIMITS = httpx.Limits(
+    max_connections=50,
+    max_keepalive_connections=10,
+)
+CONTROL_TIMEOUT = httpx.Timeout(0.3)
+
+_upstream_client: httpx.AsyncClient | None = None
+_control_client: httpx.AsyncClient | None = None
+
+
+def get_upstream_client() -> httpx.AsyncClient:
+    global _upstream_client
+    if _upstream_client is None:
+        _upstream_client = httpx.AsyncClient(
+            timeout=UPSTREAM_TIMEOUT,
+            transport=httpx.AsyncHTTPTransport(
+                http2=True,  # Multiplex concurrent forwards per upstream origin
+                limits=UPSTREAM_LIMITS,
+                retries=UPSTREAM_CONNECT_RETRIES,
+            ),
+        )
+        # Forward only what the caller sent. httpx's default Accept-Encoding
+        # would make upstreams compress bodies the caller never asked for,
+        # and aiter_raw relays them still encoded.
+        for name in ("accept", "accept-encoding", "user-agent"):
+            del _upstream_client.headers[name]
+    return _upstream_client
+
+
+def get_control_client() -> httpx.AsyncClient:
+    global _control_client
+    if _control_client is None:
+        _control_client = httpx.AsyncClient(
+            timeout=CONTROL_TIMEOUT,
+            limits=CONTROL_LIMITS,
+        )
+    return _control_client
+
+
+async def close_all():
+    global _upstream_client, _control_client
+    for client in (_upstream_client, _control_client):
+        if client is not None:
+            await client.aclose()
+    _upstream_client = None
+    _control_client = None
@@ -1,19 +1,27 @@
 import logging
+import logging.handlers
+import queue
+import random
+import re
 import time
 import asyncio
-from datetime import datetime
-from typing import Optional
+import hashlib
+from functools import lru_cache
 
-from fastapi import FastAPI, Request, Depends, HTTPException
-from pydantic import BaseModel
+import orjson
+from cachetools import TTLCache
+from fastapi import FastAPI, Request, Response, HTTPException
 
+from config import settings
 from config_manager import config_manager
-from security import extract_api_key, validate_api_key
+from security import extract_api_key, hash_api_key
 from rate_limit import check_rate_limit
 from ml import compute_risk_score
 from decision import make_decision, Decision
-from proxy import forward_request
-from traffic_logger import emit_traffic_event, start_traffic_logger, is_logger_ready
+from proxy import forward_request, warm_pool
+from http_clients import get_upstream_client, get_control_client, close_all
+from redis_client import redis_client, preload_scripts
+from traffic_logger import emit_traffic_event, start_traffic_logger, shutdown_traffic_logger
 
 
 # ======================================================
@@ -22,129 +30,293 @@ from traffic_logger import emit_traffic_event, start_traffic_logger, is_logger_r
 
 app = FastAPI(title="SecureX Worker")
 
-logging.basicConfig(level=logging.INFO)
+# Records are handed to a background thread; stream writes never
+# happen on the event loop. The listener runs from startup to shutdown
+# (records logged before startup wait in the queue until then).
+_log_records: queue.Queue = queue.Queue(-1)
+_log_listener = logging.handlers.QueueListener(
+    _log_records, logging.StreamHandler(), respect_handler_level=True
+)
+
+logging.basicConfig(
+    level=logging.INFO,
+    handlers=[logging.handlers.QueueHandler(_log_records)],
+)
+
 logger = logging.getLogger("securex.worker")
 
 
 # ======================================================
-# Request Context (FACTS ONLY)
+# Startup
 # ======================================================
 
-class RequestContext(BaseModel):
-    timestamp: str
-    project_id: str
-    api_key_hash: str
+_background_tasks: set = set()
 
-    method: str
-    path: str
-    endpoint: str
 
-    ip: str
-    user_agent: Optional[str]
+def _spawn(coro):
+    """Run a best-effort startup job without delaying readiness."""
+    task = asyncio.create_task(coro)
+    _background_tasks.add(task)
+    task.add_done_callback(_background_tasks.discard)
 
-    risk_score: float
-    decision: str
-    reason: Optional[str]
 
-    status_code: int
-    latency_ms: int
+def _schedule_pool_warmup():
+    """Pre-connect to upstreams whenever a new config is published."""
+    urls = config_manager.upstream_base_urls()
+    if urls:
+        _spawn(warm_pool(urls))
 
 
-# ======================================================
-# Startup
-# ======================================================
-
 @app.on_event("startup")
 async def startup():
+    _log_listener.start()
+    # Bind the shared outbound pools to the running loop
+    get_upstream_client()
+    get_control_client()
+    _spawn(preload_scripts())  # Skip the NOSCRIPT fallback on first requests
+    config_manager.on_update(_schedule_pool_warmup)
     config_manager.start_background_refresh()
     start_traffic_logger()
     logger.info("Worker startup complete")
 
 
+@app.on_event("shutdown")
+async def shutdown():
+    await shutdown_traffic_logger()
+    await config_manager.close()
+    await close_all()
+    await redis_client.aclose()
+    _log_listener.stop()
+
+
+# ======================================================
+# Paths
+# ======================================================
+
+def _route_path(scope) -> str:
+    """
+    Request path relative to the app's mount point, with the leading "/".
+    ASGI servers keep root_path (e.g. uvicorn --root-path) inside "path".
+    """
+    path = scope["path"]
+    root_path = scope.get("root_path", "")
+    if root_path and path.startswith(root_path):
+        path = path[len(root_path):] or "/"
+    return path
+
+
 # ======================================================
 # Health
 # ======================================================
 
-@app.get("/health")
-def health_check():
-    try:
-        config_manager.get_instance()
-        return {"status": "ok"}
-    except Exception:
-        return {"status": "initializing"}
+_HEALTH_BODY = b'{"status":"ok"}'
+_HEALTH_START = {
+    "type": "http.response.start",
+    "status": 200,
+    "headers": [
+        (b"content-type", b"application/json"),
+        (b"content-length", str(len(_HEALTH_BODY)).encode()),
+    ],
+}
+_HEALTH_RESPONSE = {"type": "http.response.body", "body": _HEALTH_BODY}
+
+
+class HealthCheckMiddleware:
+    """
+    Answers /health before FastAPI routing.
+    LB probes cost two send() calls with static payloads.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "http" and _route_path(scope) == "/health":
+            await send(_HEALTH_START)
+            await send(_HEALTH_RESPONSE)
+            return
+        await self.app(scope, receive, send)
 
 
 # ======================================================
-# Gateway (ALL REAL TRAFFIC)
+# Auth (before routing)
 # ======================================================
 
-@app.api_route(
-    "/{path:path}",
-    methods=["GET", "POST", "PUT", "DELETE", "PATCH", "OPTIONS", "HEAD", "TRACE"],
+def _prebuilt_error(status_code: int, detail: str, extra_headers=()):
+    body = orjson.dumps({"detail": detail})
+    return (
+        {
+            "type": "http.response.start",
+            "status": status_code,
+            "headers": [
+                (b"content-type", b"application/json"),
+                (b"content-length", str(len(body)).encode()),
+                *extra_headers,
+            ],
+        },
+        {"type": "http.response.body", "body": body},
+    )
+
+
+# Raw key fingerprint -> (api_key_hash, project), for known keys only.
+# Cleared whenever a new config is published.
+_auth_cache: TTLCache = TTLCache(maxsize=10_000, ttl=60)
+config_manager.on_update(_auth_cache.clear)
+
+# OPTIONS is forwarded like any other method: CORS belongs to the upstream.
+# TRACE is never proxied (it reflects credentials back to the caller).
+GATEWAY_METHODS = frozenset(
+    {"GET", "POST", "PUT", "DELETE", "PATCH", "OPTIONS", "HEAD"}
 )
-async def gateway(
-    path: str,
-    request: Request,
-    raw_api_key: str = Depends(extract_api_key),
-):
-    start_time = time.monotonic()
 
-    method = request.method
-    client_ip = request.client.host if request.client else "unknown"
-    user_agent = request.headers.get("user-agent")
+# RFC 9110 15.5.6: a 405 must list the supported methods
+_METHOD_NOT_ALLOWED_RESPONSE = _prebuilt_error(
+    405,
+    "Method Not Allowed",
+    [(b"allow", b", ".join(sorted(m.encode() for m in GATEWAY_METHODS)))],
+)
+_MISSING_KEY_RESPONSE = _prebuilt_error(401, "API key missing")
+_UNKNOWN_KEY_RESPONSE = _prebuilt_error(401, "Invalid API key")
 
-    canonical_endpoint = normalize_path(path)
 
-    # --------------------------------------------------
-    # API Key Validation
-    # --------------------------------------------------
+class ApiKeyAuthMiddleware:
+    """
+    Resolves API key -> project once, before FastAPI routing.
 
-    try:
-        api_key_hash = validate_api_key(raw_api_key)
-    except Exception:
-        await reject(
-            start_time=start_time,
-            project_id="unknown",
-            api_key_hash="invalid",
-            method=method,
-            path=path,
-            endpoint=canonical_endpoint,
-            ip=client_ip,
-            user_agent=user_agent,
-            reason="Missing or invalid API key",
-            status_code=401,
-        )
+    Rejected requests are answered with a prebuilt 401 and never reach
+    the router. Accepted ones carry start_time, api_key_hash and project
+    on request.state.
+    """
 
-    project = config_manager.get_project_by_key(api_key_hash)
-    if not project:
-        await reject(
-            start_time=start_time,
-            project_id="unknown",
-            api_key_hash=api_key_hash,
-            method=method,
-            path=path,
-            endpoint=canonical_endpoint,
-            ip=client_ip,
-            user_agent=user_agent,
-            reason="Invalid API key",
-            status_code=401,
-        )
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        # Unsupported methods never cost a key lookup
+        if scope["method"] not in GATEWAY_METHODS:
+            await _send_prebuilt(send, _METHOD_NOT_ALLOWED_RESPONSE)
+            return
+
+        start_time = time.monotonic()
+        request = Request(scope)
+
+        try:
+            raw_api_key = extract_api_key(request)
+        except HTTPException:
+            await _send_prebuilt(send, _MISSING_KEY_RESPONSE)
+            return
+
+        fingerprint = hashlib.blake2b(raw_api_key.encode(), digest_size=16).digest()
+        cached = _auth_cache.get(fingerprint)
+
+        if cached is not None:
+            api_key_hash, project = cached
+        else:
+            # extract_api_key guarantees a non-empty key: hash and look up directly
+            api_key_hash = hash_api_key(raw_api_key)
+            project = config_manager.get_project_by_key(api_key_hash)
+            if not project:
+                _emit_auth_failure(request, start_time, api_key_hash, "Invalid API key")
+                await _send_prebuilt(send, _UNKNOWN_KEY_RESPONSE)
+                return
+
+            _auth_cache[fingerprint] = (api_key_hash, project)
+
+        state = scope.setdefault("state", {})
+        state["start_time"] = start_time
+        state["api_key_hash"] = api_key_hash
+        state["project"] = project
+
+        await self.app(scope, receive, send)
+
+
+async def _send_prebuilt(send, response):
+    start, body = response
+    await send(start)
+    await send(body)
+
+
+def _emit_auth_failure(request: Request, start_time, api_key_hash, reason):
+    path = _route_path(request.scope)[1:]
+    emit_event(
+        start_time=start_time,
+        project_id="unknown",
+        api_key_hash=api_key_hash,
+        method=request.method,
+        path=path,
+        endpoint=normalize_path(path),
+        ip=request.client.host if request.client else "unknown",
+        user_agent=request.headers.get("user-agent"),
+        risk_score=0.0,
+        decision=Decision.BLOCK.value,
+        reason=reason,
+        status_code=401,
+    )
+
+
+# ======================================================
+# Middleware (outermost last)
+# ======================================================
+
+app.add_middleware(ApiKeyAuthMiddleware)
+app.add_middleware(HealthCheckMiddleware)
+
+
+# ======================================================
+# Gateway (ALL REAL TRAFFIC)
+# ======================================================
+
+async def gateway_app(scope, receive, send):
+    """
+    Raw ASGI catch-all mounted at "/".
+    Skips FastAPI route matching and parameter handling entirely.
+    """
+    request = Request(scope, receive)
+    response = await gateway(_route_path(scope)[1:], request)
+    await response(scope, receive, send)
+
+
+async def gateway(path: str, request: Request):
+    # Resolved by ApiKeyAuthMiddleware
+    start_time = request.state.start_time
+    api_key_hash = request.state.api_key_hash
+    project = request.state.project
+
+    method = request.method
+    client = request.scope.get("client")  # Skips the Address namedtuple
+    client_ip = client[0] if client else "unknown"
+    user_agent = request.headers.get("user-agent")
+
+    canonical_endpoint = normalize_path(path)
 
     # --------------------------------------------------
     # Rate Limit + ML Risk
     # --------------------------------------------------
 
-    rate_allowed, remaining = check_rate_limit(
+    rate_check = check_rate_limit(
         api_key_hash=api_key_hash,
         ip_address=client_ip,
         endpoint=canonical_endpoint,
     )
 
-    risk_score = compute_risk_score(
-        api_key_hash=api_key_hash,
-        ip_address=client_ip,
-        endpoint=canonical_endpoint,
-    ).get("risk_score", 0.0)
+    if settings.ML_ENABLED:
+        # Independent Redis round-trips: overlap them
+        (rate_allowed, remaining), ml_result = await asyncio.gather(
+            rate_check,
+            compute_risk_score(
+                api_key_hash=api_key_hash,
+                ip_address=client_ip,
+                endpoint=canonical_endpoint,
+            ),
+        )
+        risk_score = ml_result.get("risk_score", 0.0)
+    else:
+        rate_allowed, remaining = await rate_check
+        risk_score = 0.0
 
     decision_result = make_decision(
         rate_limit_allowed=rate_allowed,
@@ -156,10 +328,25 @@ async def gateway(
     reason = decision_result.get("reason")
 
     if decision == Decision.THROTTLE:
-        await asyncio.sleep(0.3)
+        # Back-off is signalled to the client; no coroutine is parked here
+        return await reject(
+            start_time=start_time,
+            project_id=project.project_id,
+            api_key_hash=api_key_hash,
+            method=method,
+            path=path,
+            endpoint=canonical_endpoint,
+            ip=client_ip,
+            user_agent=user_agent,
+            reason=reason or "Throttled",
+            status_code=429,
+            risk_score=risk_score,
+            decision=Decision.THROTTLE.value,
+            headers={"Retry-After": "1"},
+        )
 
     if decision == Decision.BLOCK:
-        await reject(
+        return await reject(
             start_time=start_time,
             project_id=project.project_id,
             api_key_hash=api_key_hash,
@@ -177,7 +364,7 @@ async def gateway(
     # Forward (FIXED)
     # --------------------------------------------------
 
-    upstream_url = f"{project.upstream_base_url.rstrip('/')}/{path}"
+    upstream_url = f"{project.upstream_base_url_normalized}/{path}"
 
     try:
         response = await forward_request(
@@ -201,20 +388,21 @@ async def gateway(
         )
         raise
 
-    emit_event(
-        start_time=start_time,
-        project_id=project.project_id,
-        api_key_hash=api_key_hash,
-        method=method,
-        path=path,
-        endpoint=canonical_endpoint,
-        ip=client_ip,
-        user_agent=user_agent,
-        risk_score=risk_score,
-        decision=Decision.ALLOW.value,
-        reason=None,
-        status_code=response.status_code,
-    )
+    if sample_success_event():
+        emit_event(
+            start_time=start_time,
+            project_id=project.project_id,
+            api_key_hash=api_key_hash,
+            method=method,
+            path=path,
+            endpoint=canonical_endpoint,
+            ip=client_ip,
+            user_agent=user_agent,
+            risk_score=risk_score,
+            decision=Decision.ALLOW.value,
+            reason=None,
+            status_code=response.status_code,
+        )
 
     return response
 
@@ -223,12 +411,37 @@ async def gateway(
 # Helpers
 # ======================================================
 
+_EMPTY_SEGMENTS = re.compile(r"/{2,}")
+_ID_SEGMENT = re.compile(r"/\d+(?=/|$)")
+
+
+@lru_cache(maxsize=4096)
 def normalize_path(path: str) -> str:
-    return "/" + "/".join(
-        ":id" if segment.isdigit() else segment
-        for segment in path.split("/")
-        if segment
-    )
+    path = "/" + path.strip("/")
+    if "//" in path:
+        path = _EMPTY_SEGMENTS.sub("/", path)
+    return _ID_SEGMENT.sub("/:id", path)
+
+
+def sample_success_event() -> bool:
+    rate = settings.TELEMETRY_SAMPLE_RATE
+    return rate >= 1.0 or random.random() < rate
+
+
+_ts_cache = (0, "")
+
+
+def iso_now() -> str:
+    """
+    UTC ISO-8601 timestamp with milliseconds.
+    The seconds prefix is formatted at most once per second.
+    """
+    global _ts_cache
+    now = time.time()
+    sec = int(now)
+    if sec != _ts_cache[0]:
+        _ts_cache = (sec, time.strftime("%Y-%m-%dT%H:%M:%S", time.gmtime(sec)))
+    return f"{_ts_cache[1]}.{int((now - sec) * 1000):03d}Z"
 
 
 def emit_event(
@@ -245,30 +458,29 @@ def emit_event(
     reason,
     status_code,
 ):
-    latency_ms = int((time.monotonic() - start_time) * 1000)
-
-    ctx = RequestContext(
-        timestamp=datetime.utcnow().isoformat(),
-        project_id=project_id,
-        api_key_hash=api_key_hash,
-        method=method,
-        path=path,
-        endpoint=endpoint,
-        ip=ip,
-        user_agent=user_agent,
-        risk_score=risk_score,
-        decision=decision,
-        reason=reason,
-        status_code=status_code,
-        latency_ms=latency_ms,
-    )
-
-    logger.info(ctx.json())
-
-    if not is_logger_ready():
-        return
-
-    emit_traffic_event(ctx.dict())
+    # Traffic event (FACTS ONLY). Every field comes from worker code,
+    # so it is built as a plain dict: no model, no validation, one export.
+    data = {
+        "timestamp": iso_now(),
+        "project_id": project_id,
+        "api_key_hash": api_key_hash,
+        "method": method,
+        "path": path,
+        "endpoint": endpoint,
+        "ip": ip,
+        "user_agent": user_agent,
+        "risk_score": risk_score,
+        "decision": decision,
+        "reason": reason,
+        "status_code": status_code,
+        "latency_ms": int((time.monotonic() - start_time) * 1000),
+    }
+
+    if logger.isEnabledFor(logging.INFO):
+        logger.info(orjson.dumps(data).decode())
+
+    # Plain put_nowait onto the batch queue; no-op until the worker starts
+    emit_traffic_event(data)
 
 
 async def reject(
@@ -284,6 +496,8 @@ async def reject(
     reason,
     status_code,
     risk_score=0.0,
+    decision=Decision.BLOCK.value,
+    headers=None,
 ):
     emit_event(
         start_time=start_time,
@@ -295,8 +509,18 @@ async def reject(
         ip=ip,
         user_agent=user_agent,
         risk_score=risk_score,
-        decision=Decision.BLOCK.value,
+        decision=decision,
         reason=reason,
         status_code=status_code,
     )
-    raise HTTPException(status_code=status_code, detail=reason)
+    # Answered directly with an orjson body: no HTTPException round-trip
+    # through FastAPI's exception handler and stdlib json
+    return Response(
+        content=orjson.dumps({"detail": reason}),
+        status_code=status_code,
+        headers=headers,
+        media_type="application/json",
+    )
+
+
+app.mount("/", gateway_app)
@@ -1,13 +1,27 @@
 import time
 from typing import Dict
 
-from redis_client import redis_client
+from redis_client import register_script
 
 
 WINDOW_SECONDS = 60
 
+# One round-trip for every signal's Redis state.
+# KEYS[1]=velocity counter, KEYS[2]=endpoint set
+# ARGV[1]=window seconds,    ARGV[2]=endpoint
+# Returns {velocity, endpoint_count}
+_SIGNALS_LUA = """
+local v = redis.call('INCR', KEYS[1])
+if v == 1 then redis.call('EXPIRE', KEYS[1], ARGV[1]) end
+redis.call('SADD', KEYS[2], ARGV[2])
+redis.call('EXPIRE', KEYS[2], ARGV[1])
+return {v, redis.call('SCARD', KEYS[2])}
+"""
 
-def compute_risk_score(
+_signals_script = register_script(_SIGNALS_LUA)
+
+
+async def compute_risk_score(
     *,
     api_key_hash: str,
     ip_address: str,
@@ -19,14 +33,17 @@ def compute_risk_score(
 
     signals = {}
 
+    velocity_key = f"ml:velocity:{api_key_hash}:{ip_address}:{endpoint}"
+    drift_key = f"ml:endpoints:{api_key_hash}:{ip_address}"
+
+    velocity, endpoint_count = await _signals_script(
+        keys=[velocity_key, drift_key],
+        args=[WINDOW_SECONDS, endpoint],
+    )
+
     # -------------------------
     # 1. Velocity Signal
     # -------------------------
-    velocity_key = f"ml:velocity:{api_key_hash}:{ip_address}:{endpoint}"
-    velocity = redis_client.incr(velocity_key)
-    if velocity == 1:
-        redis_client.expire(velocity_key, WINDOW_SECONDS)
-
     velocity_score = min(velocity / 30.0, 1.0)
     signals["velocity"] = velocity_score
 
@@ -39,11 +56,6 @@ def compute_risk_score(
     # -------------------------
     # 3. Endpoint Drift Signal
     # -------------------------
-    drift_key = f"ml:endpoints:{api_key_hash}:{ip_address}"
-    redis_client.sadd(drift_key, endpoint)
-    redis_client.expire(drift_key, WINDOW_SECONDS)
-
-    endpoint_count = redis_client.scard(drift_key)
     drift_score = min(endpoint_count / 5.0, 1.0)
     signals["endpoint_drift"] = drift_score
 
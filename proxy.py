@@ -1,53 +1,109 @@
+import asyncio
+import logging
 import httpx
-from typing import Dict
+from typing import Iterable, List, Optional, Tuple
 
 from fastapi import Request, HTTPException, status
-from fastapi.responses import StreamingResponse
+
+from config import settings
+from http_clients import get_upstream_client
+
+logger = logging.getLogger(__name__)
 
 # --------------------------------------------------
 # Hop-by-hop headers (RFC compliant)
 # --------------------------------------------------
 
-HOP_BY_HOP_HEADERS = {
-    "connection",
-    "keep-alive",
-    "proxy-authenticate",
-    "proxy-authorization",
-    "te",
-    "trailers",
-    "transfer-encoding",
-    "upgrade",
-    "host",
-}
+HOP_BY_HOP_HEADERS = frozenset((
+    b"connection",
+    b"keep-alive",
+    b"proxy-authenticate",
+    b"proxy-authorization",
+    b"te",
+    b"trailers",
+    b"transfer-encoding",
+    b"upgrade",
+    b"host",
+))
+
+
+def _filter_headers(raw: Iterable[Tuple[bytes, bytes]]) -> List[Tuple[bytes, bytes]]:
+    """
+    Drop hop-by-hop headers from raw (name, value) pairs in a single pass.
+    Names come back lowercased, as ASGI requires.
+    """
+    return [
+        (name, v)
+        for k, v in raw
+        if (name := k.lower()) not in HOP_BY_HOP_HEADERS
+    ]
 
 
-def _filter_headers(headers: Dict[str, str]) -> Dict[str, str]:
-    return {
-        k: v
-        for k, v in headers.items()
-        if k.lower() not in HOP_BY_HOP_HEADERS
-    }
+def _has_body(raw: Iterable[Tuple[bytes, bytes]]) -> bool:
+    """
+    A request carries a body only if it is framed by one (RFC 9112 6.3).
+    ASGI header names are already lowercase.
+    """
+    for k, v in raw:
+        if k == b"transfer-encoding" or (k == b"content-length" and v != b"0"):
+            return True
+    return False
 
 
 # --------------------------------------------------
-# SHARED HTTP CLIENT (IMPORTANT)
+# Streaming
 # --------------------------------------------------
 
-_client: httpx.AsyncClient | None = None
+# Coalesce upstream reads into fewer, larger ASGI body messages.
+# Applied only to bodies with a known content-length: chunked or
+# open-ended replies (SSE, NDJSON, long-poll) are relayed as they arrive.
+STREAM_CHUNK_SIZE = settings.PROXY_CHUNK_SIZE or None
 
+_END_OF_BODY = {"type": "http.response.body", "body": b"", "more_body": False}
 
-def get_client() -> httpx.AsyncClient:
-    global _client
-    if _client is None:
-        _client = httpx.AsyncClient(timeout=30.0)
-    return _client
 
+class UpstreamResponse:
+    """
+    Pure-passthrough ASGI response for a streamed upstream reply.
+    Sends the filtered upstream headers and raw body chunks straight to
+    the server, then releases the upstream connection to the pool.
+    """
 
-async def close_client():
-    global _client
-    if _client:
-        await _client.aclose()
-        _client = None
+    __slots__ = ("status_code", "raw_headers", "_upstream", "_chunk_size")
+
+    def __init__(self, upstream: httpx.Response, chunk_size: Optional[int]):
+        self.status_code = upstream.status_code
+        self.raw_headers = _filter_headers(upstream.headers.raw)
+        self._upstream = upstream
+        self._chunk_size = chunk_size
+
+    async def __call__(self, scope, receive, send):
+        try:
+            await send({
+                "type": "http.response.start",
+                "status": self.status_code,
+                "headers": self.raw_headers,
+            })
+            async for chunk in self._upstream.aiter_raw(chunk_size=self._chunk_size):
+                await send({"type": "http.response.body", "body": chunk, "more_body": True})
+            await send(_END_OF_BODY)
+        finally:
+            await self._upstream.aclose()
+
+
+async def warm_pool(base_urls: Iterable[str]):
+    """
+    Open a keep-alive connection to each upstream ahead of real traffic.
+    Best effort: an unreachable upstream is only logged.
+    """
+    client = get_upstream_client()
+    results = await asyncio.gather(
+        *(client.head(url) for url in base_urls),
+        return_exceptions=True,
+    )
+    failed = sum(isinstance(r, Exception) for r in results)
+    if failed:
+        logger.warning(f"Pool warm-up: {failed}/{len(results)} upstreams unreachable")
 
 
 # --------------------------------------------------
@@ -58,29 +114,32 @@ async def forward_request(
     *,
     request: Request,
     upstream_url: str,
-) -> StreamingResponse:
+) -> UpstreamResponse:
     """
     Transparently forward request to upstream and stream response back.
     """
-    client = get_client()
+    client = get_upstream_client()
+
+    raw_headers = request.headers.raw
 
     try:
         upstream_req = client.build_request(
             method=request.method,
             url=upstream_url,
-            headers=_filter_headers(dict(request.headers)),
+            headers=_filter_headers(raw_headers),
             params=request.query_params,
-            content=request.stream(),
+            # Bodyless requests (most GETs) skip the receive() stream wrapper
+            content=request.stream() if _has_body(raw_headers) else None,
         )
 
         upstream_resp = await client.send(upstream_req, stream=True)
 
-        return StreamingResponse(
-            upstream_resp.aiter_raw(),
-            status_code=upstream_resp.status_code,
-            headers=_filter_headers(dict(upstream_resp.headers)),
-            media_type=upstream_resp.headers.get("content-type"),
-        )
+        # httpx's chunker holds bytes until chunk_size builds up, which
+        # would stall any body the upstream is still producing
+        framed = "content-length" in upstream_resp.headers
+        chunk_size = STREAM_CHUNK_SIZE if framed else None
+
+        return UpstreamResponse(upstream_resp, chunk_size)
 
     except httpx.RequestError as e:
         raise HTTPException(
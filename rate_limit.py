@@ -1,7 +1,7 @@
 import time
 from typing import Tuple
 
-from redis_client import redis_client
+from redis_client import register_script
 
 
 # =========================
@@ -16,20 +16,47 @@ ENDPOINT_LIMITS = {
 
 DEFAULT_PROFILE = "MEDIUM"
 
+# Hot-path form of each profile: (interval_ms, tolerance_ms, burst)
+_GCRA_PARAMS = {
+    name: (
+        60_000 // p["rpm"],
+        (p["rpm"] + p["burst"]) * (60_000 // p["rpm"]),
+        p["burst"],
+    )
+    for name, p in ENDPOINT_LIMITS.items()
+}
+
+# GCRA: one "theoretical arrival time" (ms) per key, advanced by one
+# emission interval per accepted request. A request is refused when it
+# would push TAT more than `tolerance` ahead of now. Refill is continuous,
+# so there are no window boundaries to burst across.
+# KEYS[1]=tat key, ARGV[1]=now ms, ARGV[2]=interval ms, ARGV[3]=tolerance ms
+# Returns {allowed, tokens_left}
+_GCRA_LUA = """
+local now = tonumber(ARGV[1])
+local interval = tonumber(ARGV[2])
+local tolerance = tonumber(ARGV[3])
+local tat = math.max(tonumber(redis.call('GET', KEYS[1])) or 0, now)
+local new_tat = tat + interval
+if new_tat - now > tolerance then
+  return {0, 0}
+end
+redis.call('SET', KEYS[1], new_tat, 'PX', new_tat - now)
+return {1, math.floor((now + tolerance - new_tat) / interval)}
+"""
+
+_gcra_script = register_script(_GCRA_LUA)
+
 
 # =========================
 # Helpers
 # =========================
 
-def _current_minute() -> int:
-    return int(time.time() // 60)
-
-
 def rate_limit_key(api_key_hash: str, ip_address: str, endpoint: str) -> str:
-    return f"rate_limit:{api_key_hash}:{ip_address}:{endpoint}:{_current_minute()}"
+    return f"rate_limit:{api_key_hash}:{ip_address}:{endpoint}"
 
 
-def check_rate_limit(
+async def check_rate_limit(
     api_key_hash: str,
     ip_address: str,
     endpoint: str,
@@ -38,27 +65,27 @@ def check_rate_limit(
     Global default rate limiting for all endpoints.
     SecureX does not classify application routes.
 
+    Sustained rate is `rpm`; up to rpm + burst requests are accepted
+    back-to-back from idle.
+
     Returns:
         allowed (bool)
-        remaining_requests (int)
+        remaining_requests (int) - headroom before the burst allowance
     """
 
     profile = DEFAULT_PROFILE
-    limits = ENDPOINT_LIMITS[profile]
-
-    rpm = limits["rpm"]
-    burst = limits["burst"]
+    interval_ms, tolerance_ms, burst = _GCRA_PARAMS[profile]
 
     key = rate_limit_key(api_key_hash, ip_address, endpoint)
 
-    current_count = redis_client.incr(key)
-
-    if current_count == 1:
-        redis_client.expire(key, 60)
+    allowed, tokens_left = await _gcra_script(
+        keys=[key],
+        args=[time.time_ns() // 1_000_000, interval_ms, tolerance_ms],
+    )
 
     # ---- HARD BLOCK ----
-    if current_count > rpm + burst:
+    if not allowed:
         return False, 0
 
-    remaining = max(rpm - current_count, 0)
+    remaining = max(tokens_left - burst, 0)
     return True, remaining
@@ -1,8 +1,45 @@
-import redis
+import logging
+from typing import List
+
+from redis.asyncio import BlockingConnectionPool, Redis
+from redis.commands.core import AsyncScript
 from config import settings
 
-redis_client = redis.Redis.from_url(
-    settings.REDIS_URL,
-    decode_responses=True,
-    ssl_cert_reqs=None,  # REQUIRED for Upstash
+logger = logging.getLogger(__name__)
+
+# Async client: Redis round-trips must never block the event loop.
+# Bounded pool; under a spike callers wait briefly for a free connection
+# instead of failing with "Too many connections".
+redis_client = Redis.from_pool(  # Owns the pool: aclose() disconnects it
+    BlockingConnectionPool.from_url(
+        settings.REDIS_URL,
+        decode_responses=True,
+        ssl_cert_reqs=None,  # REQUIRED for Upstash
+        max_connections=100,
+        timeout=2,
+    )
 )
+
+_scripts: List[AsyncScript] = []
+
+
+def register_script(lua: str) -> AsyncScript:
+    """
+    Register a Lua script, invoked via EVALSHA.
+    A NOSCRIPT reply (e.g. after a Redis restart) reloads it transparently.
+    """
+    script = redis_client.register_script(lua)
+    _scripts.append(script)
+    return script
+
+
+async def preload_scripts():
+    """
+    SCRIPT LOAD every registered script so the first request in each
+    path skips the NOSCRIPT -> EVAL fallback. Best effort.
+    """
+    try:
+        for script in _scripts:
+            await redis_client.script_load(script.script)
+    except Exception as e:
+        logger.warning(f"Redis script preload failed (lazy load on first use): {type(e).__name__}")
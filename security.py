@@ -1,6 +1,10 @@
 import hashlib
+import hmac
+from functools import lru_cache
 from fastapi import HTTPException, status, Request
 
+from config import settings
+
 # =========================
 # API KEY EXTRACTION
 # =========================
@@ -10,7 +14,17 @@ def extract_api_key(request: Request) -> str:
     Extract API key from request headers.
     Supports: x-securex-api-key (SecureX) or x-api-key (standard)
     """
-    api_key = request.headers.get("x-securex-api-key") or request.headers.get("x-api-key")
+    # Scan the raw ASGI pairs (names already lowercase) instead of
+    # building a Headers view; only the matched value is decoded.
+    securex_key = standard_key = None
+    for name, value in request.scope["headers"]:
+        if name == b"x-securex-api-key" and securex_key is None:
+            securex_key = value
+        elif name == b"x-api-key" and standard_key is None:
+            standard_key = value
+
+    raw = securex_key or standard_key
+    api_key = raw.decode("latin-1") if raw else None
     if not api_key:
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
@@ -23,27 +37,30 @@ def extract_api_key(request: Request) -> str:
 # HASHING
 # =========================
 
-def hash_api_key(raw_key: str) -> str:
-    """
-    Hash API key using SHA-256.
-    Raw keys are NEVER stored or logged.
-    """
-    return hashlib.sha256(raw_key.encode()).hexdigest()
+# Longer values are hashed but never memoized, so junk headers cannot
+# pin large strings in the cache.
+MAX_CACHED_KEY_LENGTH = 128
 
 
-# =========================
-# VALIDATION (PROJECT-BASED)
-# =========================
+_PEPPER = settings.API_KEY_PEPPER.encode() if settings.API_KEY_PEPPER else None
+
+
+def _digest_hex(raw_key: str) -> str:
+    if _PEPPER is None:
+        return hashlib.sha256(raw_key.encode()).hexdigest()
+    return hmac.new(_PEPPER, raw_key.encode(), hashlib.sha256).hexdigest()
 
-def validate_api_key(raw_api_key: str) -> str:
+
+_cached_digest_hex = lru_cache(maxsize=8192)(_digest_hex)
+
+
+def hash_api_key(raw_key: str) -> str:
     """
-    Validate API key format and return hash.
-    Project existence is checked elsewhere.
+    Hash API key using SHA-256 (HMAC-SHA256 when a pepper is configured).
+    Raw keys are never logged or persisted, but keys up to
+    MAX_CACHED_KEY_LENGTH are held in process memory by the digest cache
+    (up to 8192 entries, including keys that fail to resolve).
     """
-    if not raw_api_key:
-        raise HTTPException(
-            status_code=status.HTTP_401_UNAUTHORIZED,
-            detail="Invalid API key",
-        )
-
-    return hash_api_key(raw_api_key)
+    if len(raw_key) > MAX_CACHED_KEY_LENGTH:
+        return _digest_hex(raw_key)
+    return _cached_digest_hex(raw_key)
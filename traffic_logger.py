@@ -1,9 +1,11 @@
 import asyncio
 import logging
-from typing import Dict, Optional
+from collections import deque
+from typing import Deque, Dict, List, Optional
 
-import httpx
+import orjson
 from config import settings
+from http_clients import get_control_client
 
 logger = logging.getLogger("securex.worker.traffic")
 
@@ -12,30 +14,29 @@ logger = logging.getLogger("securex.worker.traffic")
 # ======================================================
 
 QUEUE_MAX_SIZE = 1000        # Max logs kept in memory
-SEND_TIMEOUT = 0.3           # Hard timeout per request (seconds)
-MAX_CONNECTIONS = 50
-KEEPALIVE_CONNECTIONS = 10
+BATCH_MAX_SIZE = settings.TRAFFIC_BATCH_SIZE        # Max events per POST
+BATCH_LINGER = settings.TRAFFIC_BATCH_MS / 1000.0   # Max wait to fill a batch (s)
+
+TRAFFIC_URL = f"{settings.CONTROL_API_BASE_URL}/internal/traffic/batch"
+TRAFFIC_HEADERS = [
+    ("content-type", "application/json"),
+    ("x-control-secret", settings.CONTROL_WORKER_SHARED_SECRET),
+]
 
 # ======================================================
 # Internal State
 # ======================================================
 
-_log_queue: asyncio.Queue[Dict] = asyncio.Queue(maxsize=QUEUE_MAX_SIZE)
+# Single producer side (the event loop), single consumer: a deque plus
+# two Events is all the coordination needed. _wake fires on the first
+# queued event, _full as soon as a whole batch is waiting.
+_log_queue: Deque[Dict] = deque()
+_wake = asyncio.Event()
+_full = asyncio.Event()
 _worker_task: Optional[asyncio.Task] = None
 _worker_started = False
-
-
-# ======================================================
-# Shared HTTP Client
-# ======================================================
-
-_http_client = httpx.AsyncClient(
-    timeout=httpx.Timeout(SEND_TIMEOUT),
-    limits=httpx.Limits(
-        max_connections=MAX_CONNECTIONS,
-        max_keepalive_connections=KEEPALIVE_CONNECTIONS,
-    ),
-)
+_dropped_events = 0
+_reported_drops = 0
 
 
 # ======================================================
@@ -44,7 +45,7 @@ _http_client = httpx.AsyncClient(
 
 async def _traffic_worker():
     """
-    Drains the traffic queue forever.
+    Drains the traffic queue forever, one batch per POST.
 
     HARD GUARANTEE:
     - MUST NEVER crash
@@ -53,20 +54,51 @@ async def _traffic_worker():
     logger.info("Traffic worker started")
 
     while True:
-        event = await _log_queue.get()
-        try:
-            await _http_client.post(
-                f"{settings.CONTROL_API_BASE_URL}/internal/traffic",
-                json=event,
-                headers={
-                    "x-control-secret": settings.CONTROL_WORKER_SHARED_SECRET
-                },
-            )
-        except Exception as e:
-            # Control plane failure must NOT affect data plane
-            logger.debug(f"Traffic send failed (dropped): {e}")
-        finally:
-            _log_queue.task_done()
+        if not _log_queue:
+            _wake.clear()
+            await _wake.wait()
+
+        if len(_log_queue) < BATCH_MAX_SIZE:
+            # Linger for more events, but flush early once the batch fills
+            _full.clear()
+            try:
+                await asyncio.wait_for(_full.wait(), BATCH_LINGER)
+            except asyncio.TimeoutError:
+                pass
+
+        await _send_batch(_take_batch())
+        _report_drops()
+
+
+def _report_drops() -> None:
+    """One warning per batch cycle with the drops since the last one."""
+    global _reported_drops
+    dropped = _dropped_events - _reported_drops
+    if dropped:
+        _reported_drops = _dropped_events
+        logger.warning(
+            f"Traffic queue full: dropped {dropped} events "
+            f"({_dropped_events} since start)"
+        )
+
+
+def _take_batch() -> List[Dict]:
+    return [
+        _log_queue.popleft()
+        for _ in range(min(len(_log_queue), BATCH_MAX_SIZE))
+    ]
+
+
+async def _send_batch(batch: List[Dict]) -> None:
+    try:
+        await get_control_client().post(
+            TRAFFIC_URL,
+            content=orjson.dumps(batch),
+            headers=TRAFFIC_HEADERS,
+        )
+    except Exception as e:
+        # Control plane failure must NOT affect data plane
+        logger.debug(f"Traffic send failed (dropped {len(batch)}): {e}")
 
 
 # ======================================================
@@ -107,12 +139,18 @@ async def shutdown_traffic_logger():
     if _worker_task:
         _worker_task.cancel()
 
-    await _http_client.aclose()
+    await flush_traffic_logger()
     logger.info("Traffic logger shut down")
 
 
-def is_logger_ready() -> bool:
-    return _worker_started
+async def flush_traffic_logger():
+    """
+    Send everything queued right now, without waiting for the batch linger.
+    Used on shutdown and by tests instead of sleeping on the worker.
+    """
+    while _log_queue:
+        await _send_batch(_take_batch())
+    _report_drops()
 
 
 # ======================================================
@@ -129,6 +167,7 @@ def emit_traffic_event(event: Dict) -> None:
     - Bounded memory
     - Control plane can be DEAD
     """
+    global _dropped_events
 
     if not _worker_started:
         return
@@ -137,8 +176,13 @@ def emit_traffic_event(event: Dict) -> None:
     if "normalized_path" in event and "endpoint" not in event:
         event["endpoint"] = event.pop("normalized_path")
 
-    try:
-        _log_queue.put_nowait(event)
-    except asyncio.QueueFull:
+    if len(_log_queue) >= QUEUE_MAX_SIZE:
         # Correct behavior: drop under pressure
-        logger.debug("Traffic queue full — dropping event")
+        _dropped_events += 1
+        logger.debug(f"Traffic queue full — dropping event ({_dropped_events} dropped)")
+        return
+
+    _log_queue.append(event)
+    _wake.set()
+    if len(_log_queue) >= BATCH_MAX_SIZE:
+        _full.set()